@@ -0,0 +1,49 @@
+#! /usr/bin/env python
+
+import sys
+sys.path.append("../")
+
+from pyctapi import pyctapi
+from pyctapi import engine
+
+server_params = (
+    ("127.0.0.1", "engineer", "control",),
+    ("127.0.0.2", "engineer", "control",),
+)
+
+cluster_params = (
+    ("127.0.0.3", "engineer", "control",),
+    ("127.0.0.4", "engineer", "control",),
+)
+
+def print_func(stuff):
+    print("print_func callback")
+    print(stuff)
+
+# Load the DLLs once up front
+pyctapi.load_library()
+
+ct = engine.CTAPIEngine(workers=4)
+try:
+    for params in server_params:
+        ct.add_server(params)
+    ct.add_cluster(cluster_params)
+
+    ct.add_list("mytags")
+    ct.add_tag("mytags", "KNODLRS_PM10_CALC_24H")
+    ct.add_tag("mytags", "BULGA___PM10_CALC_24H")
+    ct.add_tag("mytags", "MAISOND_PM10_CALC_24H")
+    ct.subscribe("mytags", print_func)
+
+    input("Hit enter to print stats")
+    stats = ct.stats()
+    for server_stats in stats["servers"]:
+        print(server_stats)
+    print("Servers holding a worker", stats["holding_worker"], "threads", stats["threads"])
+
+    input("Hit enter to stop")
+
+except KeyboardInterrupt as e:
+    pass
+finally:
+    ct.die()
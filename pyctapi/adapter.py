@@ -32,13 +32,13 @@ class CTAPIGeneralError(Exception):
 
 class CTAPIAdapter:
     '''Python-ise the ctypes wrapper'''
-    def __init__(self, citect_host, citect_username, citect_password, mode=pyctapi.CT_OPEN_NO_OPTION, dll_path="C:/Program Files (x86)/Schneider Electric/CitectSCADA 7.50/Bin"):
+    def __init__(self, citect_host, citect_username, citect_password, mode=pyctapi.CT_OPEN_NO_OPTION, dll_path=pyctapi.DEFAULT_DLL_PATH):
         self.citect_host = citect_host
         self.citect_username = citect_username
         self.citect_password = citect_password
         self.citect_connection_mode = mode
 
-        self._ctapi = pyctapi.CTAPIWrapper(dll_path)
+        self._ctapi = pyctapi.get_wrapper(dll_path)
         self._tag_lists = {} 
         self._tag_handles = {}
 
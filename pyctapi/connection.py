@@ -8,9 +8,11 @@ from pyctapi import pyctapi
 from pyctapi import adapter
 from pyctapi.adapter import CTAPIFailedToConnect, CTAPIGeneralError, CTAPITagDoesNotExist
 
+MIN_BACKOFF_TIME = 0.5
+
 class CTAPIClusterConnection(Thread):
     '''Allows multiple connection objects to share a lock for processin callbacks'''
-    def __init__(self, cluster_params, dll_path):
+    def __init__(self, cluster_params, dll_path=pyctapi.DEFAULT_DLL_PATH):
         self._poll_lock = Lock()
         self.cluster_params = cluster_params
 
@@ -36,20 +38,19 @@ class CTAPIClusterConnection(Thread):
         for con in self.connections:
             con.die()
 
-class CTAPIConnection(Thread):
-    def __init__(self, connection_params, dll_path, scan_rate=0.1, poll_lock=None):
-        Thread.__init__(self)
+class CTAPIConnectionBase:
+    '''Tag list bookkeeping and polling shared by CTAPIConnection and the
+    engine driven CTAPIEngineConnection'''
+    def __init__(self, connection_params, dll_path=pyctapi.DEFAULT_DLL_PATH, scan_rate=0.1):
         self._dll_path = dll_path
         self._ctapi = None
         self._ok_to_run = True
         self._scan_rate = scan_rate
-        self._poll_lock = poll_lock
-
-        self.lock_status = False
-        self._backoff_time = 0.5
+        self._backoff_time = MIN_BACKOFF_TIME
 
         self.CITECT_CONNECTION_PARAMS = connection_params
 
+        self._lock = Lock()
         self.tag_lists = set() 
         self.tags = set() 
         self.tag_lists_changed = set()
@@ -57,16 +58,20 @@ class CTAPIConnection(Thread):
 
         self.subscribers = set()
 
-        self.start()
-
     def add_list(self, list_name):
-        self.tag_lists_changed.add(list_name) 
+        with self._lock:
+            self.tag_lists_changed.add(list_name) 
 
     def add_tag(self, list_name, tag_name):
-        self.tags_changed.add((list_name, tag_name,)) 
+        with self._lock:
+            self.tags_changed.add((list_name, tag_name,)) 
 
     def subscribe(self, list_name, callback):
-        self.subscribers.add((list_name, callback))
+        with self._lock:
+            self.subscribers.add((list_name, callback))
+
+    def host(self):
+        return self.CITECT_CONNECTION_PARAMS[0]
 
     def _process_events(self, tag_list):
         # Check for tag list events
@@ -81,15 +86,89 @@ class CTAPIConnection(Thread):
 
         # If no new events, do proceed to callbacks
         if len(new_events) == 0:
-            return
+            return 0
+
+        with self._lock:
+            subscribers = list(self.subscribers)
 
         # Call tag list subcribers
-        for list_name, callback in self.subscribers:
+        for list_name, callback in subscribers:
             if list_name == tag_list:
-                callback((event_date, list_name, self.host(), new_events,))
+                # A failing subscriber must not drop the events for the others
+                # or be mistaken for a CtAPI fault
+                try:
+                    callback((event_date, list_name, self.host(), new_events,))
+                except Exception as e:
+                    print(self.host(), "Subscriber callback failed", repr(e))
 
-    def host(self):
-        return self.CITECT_CONNECTION_PARAMS[0]
+        return len(new_events)
+
+    def _can_process_events(self):
+        return True
+
+    def _poll_lists(self):
+        '''Refresh every tag list once and process its events, returns the number of events'''
+        # Update internal tags lists
+        self._update_tag_lists()
+
+        event_count = 0
+        for tag_list in list(self.tag_lists):
+            # Refresh list
+            self._ctapi.refresh_list(tag_list)
+
+            if self._can_process_events():
+                event_count += self._process_events(tag_list)
+
+        return event_count
+
+    def _handle_error(self, error):
+        '''Report a CtAPI error raised while polling, returns False if the connection has to be dropped'''
+        if isinstance(error, CTAPITagDoesNotExist):
+            print(self.host(), "Tag does not exist", error)
+            return True
+
+        if error.error_code == 233:
+            print(self.host(), "Connection lost to %s" % self.host())
+            return False
+
+        print(self.host(), "error", error.error_code)
+        return error.error_code in (1, 12, 21)
+
+    def _reset_tag_lists(self):
+        # Tag lists have to be created again on a new connection
+        with self._lock:
+            self.tag_lists = set()
+            self.tags = set()
+
+    def _update_tag_lists(self):
+        with self._lock:
+            new_lists = self.tag_lists_changed - self.tag_lists
+            new_tags = self.tags_changed - self.tags
+
+        for list_name in new_lists:
+            print(self.host(), "Added tag list %s" % list_name)
+            self._ctapi.create_tag_list(list_name, pyctapi.CT_LIST_EVENT + pyctapi.CT_LIST_LIGHTWEIGHT_MODE)
+            self.tag_lists.add(list_name)
+
+        for list_name, tag_name in new_tags:
+            #print(self.host(), "Added tag %s -> %s" % (list_name, tag_name))
+            self._ctapi.add_tag_to_list(list_name, tag_name)
+            self.tags.add((list_name, tag_name,))
+
+    def _increase_backoff_time(self):
+        self._backoff_time *= 2.0
+        if self._backoff_time > 10:
+            self._backoff_time = 10
+
+class CTAPIConnection(CTAPIConnectionBase, Thread):
+    def __init__(self, connection_params, dll_path=pyctapi.DEFAULT_DLL_PATH, scan_rate=0.1, poll_lock=None):
+        CTAPIConnectionBase.__init__(self, connection_params, dll_path, scan_rate)
+        Thread.__init__(self)
+        self._poll_lock = poll_lock
+
+        self.lock_status = False
+
+        self.start()
 
     def get_poll_lock(self):
         if self._poll_lock != None:
@@ -103,6 +182,9 @@ class CTAPIConnection(Thread):
         self.lock_status = True
         return True
 
+    def _can_process_events(self):
+        return self.lock_status or self.get_poll_lock()
+
     def _read_lists(self):
         print(self.host(), "Running event check loop")
 
@@ -110,35 +192,11 @@ class CTAPIConnection(Thread):
         while self._ok_to_run:
 
             try:
-                # Update internal tags lists
-                self._update_tag_lists()
-
-                for tag_list in self.tag_lists:
-                    # Refresh list
-                    self._ctapi.refresh_list(tag_list)
-                
-                    if self.lock_status or self.get_poll_lock(): 
-                        self._process_events(tag_list)
-
-            except CTAPITagDoesNotExist as e:
-                print(self.host(), "Tag does not exist", e)
-
-            except CTAPIGeneralError as e:
-                if e.error_code == 233:
-                    print(self.host(), "Connection lost to %" % self.host())
-                    break
-                elif e.error_code == 1:
-                    print(self.host(), "error", e.error_code)
-                elif e.error_code == 12:
-                    print(self.host(), "tag problem")
-                elif e.error_code == 21:
-                    print(self.host(), "error 21")
-                else:
-                    print(self.host(), "error", e.error_code)
-                    print(self.host(), "error", pyctapi.CT_TO_WIN32_ERROR(e.error_code))
-                    print(self.host(), "error", pyctapi.WIN32_TO_CT_ERROR(e.error_code))
+                self._poll_lists()
+
+            except (CTAPITagDoesNotExist, CTAPIGeneralError) as e:
+                if not self._handle_error(e):
                     break
-                
 
             sleep(self._scan_rate)
 
@@ -147,41 +205,16 @@ class CTAPIConnection(Thread):
             self.lock_status = False
             print(self.host(), "Lock released") 
 
-    def _init_tag_lists(self):
-        for list_name in self.tag_lists:
-            print(self.host(), "Created tag list %s" % list_name)
-            self._ctapi.create_tag_list(list_name, pyctapi.CT_LIST_EVENT + pyctapi.CT_LIST_LIGHTWEIGHT_MODE)
-
-        for list_name, tag_name in self.tags:
-            #print(self.host(), "Created tag %s -> %s" % (list_name, tag_name))
-            self._ctapi.add_tag_to_list(list_name, tag_name)
-
-    def _update_tag_lists(self):
-        for list_name in self.tag_lists_changed - self.tag_lists:
-            print(self.host(), "Added tag list %s" % list_name)
-            self._ctapi.create_tag_list(list_name, pyctapi.CT_LIST_EVENT + pyctapi.CT_LIST_LIGHTWEIGHT_MODE)
-        self.tag_lists |= self.tag_lists_changed
-
-        for list_name, tag_name in self.tags_changed - self.tags:
-            #print(self.host(), "Added tag %s -> %s" % (list_name, tag_name))
-            self._ctapi.add_tag_to_list(list_name, tag_name)
-        self.tags |= self.tags_changed
-
-    def _increase_backoff_time(self):
-        self._backoff_time *= 2.0
-        if self._backoff_time > 10:
-            self._backoff_time = 10
-
     def run(self):
         host, username, password = self.CITECT_CONNECTION_PARAMS
         while self._ok_to_run:
             try:
                 with adapter.CTAPIAdapter(host, username, password, pyctapi.CT_OPEN_NO_OPTION, self._dll_path) as self._ctapi:
                     # If we get a connection reset the backoff timer
-                    self._backoff_time = 0.5
+                    self._backoff_time = MIN_BACKOFF_TIME
 
                     # Read the tags sir
-                    self._init_tag_lists()
+                    self._reset_tag_lists()
                     self._read_lists()
 
             except CTAPIFailedToConnect:
@@ -196,4 +229,3 @@ class CTAPIConnection(Thread):
         print(self.host(), "Stopping connection")
         self._ok_to_run = False
         self.join()
-
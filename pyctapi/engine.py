@@ -0,0 +1,520 @@
+#! /usr/bin/env python
+#
+# PyCtAPI Engine
+#
+# Drives many CtAPI server connections from a single
+# scheduler thread and a small fixed pool of workers
+#
+
+from time import monotonic
+from heapq import heappush, heappop
+from itertools import count
+from queue import Queue
+from collections import deque
+from threading import Thread, Lock, Condition, current_thread
+
+from pyctapi import pyctapi
+from pyctapi import adapter
+from pyctapi.adapter import CTAPIFailedToConnect, CTAPIGeneralError, CTAPITagDoesNotExist
+from pyctapi.connection import CTAPIConnectionBase, MIN_BACKOFF_TIME
+
+class CTAPIEngineStopped(Exception):
+    def __init__(self, error):
+        Exception.__init__(self, error)
+
+class CTAPIServerStats:
+    '''Scheduling statistics for a single server connection'''
+    def __init__(self, host):
+        self.host = host
+        self.connected = False
+        self.runs = 0
+        self.connects = 0
+        self.connect_failures = 0
+        self.disconnects = 0
+        self.errors = 0
+        self.events = 0
+        self.last_error = None
+        self.last_run_time = 0.0
+        self.max_run_time = 0.0
+        self.total_run_time = 0.0
+        self.last_lag = 0.0
+        self.max_lag = 0.0
+        self.overruns = 0
+        self.slow = False
+        self.stalled = False
+        self.holding_worker = False
+
+    def as_dict(self):
+        return dict(self.__dict__)
+
+class CTAPIWorkerPool:
+    '''A pool of daemon worker threads fed from a queue.
+
+    A worker stuck on a step that overran its budget is marked as stalled
+    and covered by a spare thread, up to `max_spares` of them, so `size`
+    workers stay free for the other servers. Surplus threads retire as
+    soon as the stalled steps return.'''
+    def __init__(self, name, size, max_spares=0):
+        self.name = name
+        self.size = size
+        self.max_spares = max_spares
+
+        self._queue = Queue()
+        self._lock = Lock()
+        self._threads = set()
+        self._stalled = 0
+        self._sequence = count()
+
+        with self._lock:
+            for _ in range(size):
+                self._start_thread()
+
+    def _start_thread(self):
+        # Must be called with the lock held
+        thread = Thread(target=self._work, name="%s_%d" % (self.name, next(self._sequence)), daemon=True)
+        self._threads.add(thread)
+        thread.start()
+
+    def submit(self, function, *args):
+        self._queue.put((function, args))
+
+    def stall(self):
+        with self._lock:
+            self._stalled += 1
+            if len(self._threads) - self._stalled < self.size and len(self._threads) < self.size + self.max_spares:
+                self._start_thread()
+
+    def unstall(self):
+        with self._lock:
+            self._stalled -= 1
+
+    def thread_count(self):
+        with self._lock:
+            return len(self._threads)
+
+    def _work(self):
+        while True:
+            job = self._queue.get()
+            if job == None:
+                break
+
+            function, args = job
+            function(*args)
+
+            with self._lock:
+                if len(self._threads) > self.size + self._stalled:
+                    break
+
+        with self._lock:
+            self._threads.discard(current_thread())
+
+    def shutdown(self, timeout):
+        with self._lock:
+            threads = list(self._threads)
+
+        for _ in threads:
+            self._queue.put(None)
+
+        # Stalled workers may never come back, only wait for them so long
+        deadline = monotonic() + timeout
+        for thread in threads:
+            thread.join(max(0, deadline - monotonic()))
+
+class CTAPIPollGroup:
+    '''Connections in a poll group are redundant servers, only one of them
+    delivers events to subscribers at a time'''
+    def __init__(self):
+        self._lock = Lock()
+        self.owner = None
+
+    def claim(self, connection):
+        with self._lock:
+            if self.owner == None:
+                print(connection.host(), "Poll group acquired")
+                self.owner = connection
+            return self.owner is connection
+
+    def release(self, connection):
+        with self._lock:
+            if self.owner is connection:
+                print(connection.host(), "Poll group released")
+                self.owner = None
+
+class CTAPIEngineConnection(CTAPIConnectionBase):
+    '''A single server connection driven by a CTAPIEngine.
+
+    Has the same interface as CTAPIConnection but owns no thread, every
+    refresh and event drain runs as one step on an engine worker'''
+    def __init__(self, connection_params, dll_path=pyctapi.DEFAULT_DLL_PATH, scan_rate=0.1, poll_group=None):
+        CTAPIConnectionBase.__init__(self, connection_params, dll_path, scan_rate)
+        self._poll_group = poll_group
+
+        # Scheduler bookkeeping, guarded by the engine condition
+        self._token = 0
+        self._running = False
+        self._closing = False
+        self._started = None
+        self._pool = None
+        self._slow = False
+        self._stalled = False
+        self._failing_connect = False
+
+        self.stats = CTAPIServerStats(self.host())
+
+    def _connect(self):
+        host, username, password = self.CITECT_CONNECTION_PARAMS
+        ctapi = adapter.CTAPIAdapter(host, username, password, pyctapi.CT_OPEN_NO_OPTION, self._dll_path)
+        try:
+            ctapi.connect()
+        except CTAPIFailedToConnect as e:
+            print(self.host(), "Connection failed retrying")
+            self.stats.connect_failures += 1
+            self.stats.last_error = e.error_code
+            self._increase_backoff_time()
+            return False
+
+        # If we get a connection reset the backoff timer
+        self._backoff_time = MIN_BACKOFF_TIME
+        self._ctapi = ctapi
+        self.stats.connects += 1
+        self.stats.connected = True
+
+        self._reset_tag_lists()
+        return True
+
+    def _close_later(self):
+        '''Flag the session for closing, the engine closes it on a connect worker'''
+        if self._poll_group != None:
+            self._poll_group.release(self)
+
+        if self._ctapi != None:
+            self._closing = True
+
+    def _disconnect(self):
+        if self._poll_group != None:
+            self._poll_group.release(self)
+
+        self._closing = False
+        if self._ctapi == None:
+            return
+
+        try:
+            self._ctapi._close_all()
+        except Exception as e:
+            print(self.host(), "error closing connection", e)
+
+        self._ctapi = None
+        self.stats.disconnects += 1
+        self.stats.connected = False
+
+    def _can_process_events(self):
+        return self._poll_group == None or self._poll_group.claim(self)
+
+    def _connect_step(self):
+        '''Try to open the connection, returns the delay in seconds until the next step'''
+        if self._connect():
+            return 0
+        return self._backoff_time
+
+    def _step(self):
+        '''Run one refresh cycle, returns the delay in seconds until the next one'''
+        try:
+            self.stats.events += self._poll_lists()
+
+        except (CTAPITagDoesNotExist, CTAPIGeneralError) as e:
+            self.stats.errors += 1
+            if isinstance(e, CTAPIGeneralError):
+                self.stats.last_error = e.error_code
+
+            if not self._handle_error(e):
+                self._close_later()
+                return self._backoff_time
+
+        return self._scan_rate
+
+class CTAPIEngine:
+    '''Multiplexes many server connections onto one scheduler thread and a
+    small pool of worker threads.
+
+    Each connection is run one step at a time and only rescheduled once its
+    step has finished. Connecting and closing run on a separate pool of
+    `connect_workers`, and at most `connect_workers - 1` of those may be
+    retrying hosts that already failed, so a new or recovering site always
+    has a free connect worker.
+
+    A step that runs longer than `step_budget` seconds is flagged as an
+    overrun. The worker it holds is counted as stalled and covered by a
+    spare thread, so the other servers keep their `workers` refresh threads.
+    The overrunning server is then moved to a separate pool of
+    `slow_workers` until one of its steps finishes within the budget again.
+    Blocking CtAPI calls cannot be interrupted, so more than `workers` hung
+    calls at once still exhaust the spares. The number of threads is bounded
+    by one scheduler plus twice `workers`, twice `connect_workers` and
+    `slow_workers`, no matter how many servers are added.'''
+    def __init__(self, workers=4, connect_workers=4, slow_workers=2, step_budget=1.0, dll_path=pyctapi.DEFAULT_DLL_PATH, scan_rate=0.1):
+        self._connect_workers = connect_workers
+        self._step_budget = step_budget
+        self._dll_path = dll_path
+        self._scan_rate = scan_rate
+        self._ok_to_run = True
+
+        self._condition = Condition()
+        self._queue = []
+        self._sequence = count()
+        self._refresh_pool = CTAPIWorkerPool("pyctapi-engine", workers, workers)
+        self._connect_pool = CTAPIWorkerPool("pyctapi-engine-connect", connect_workers, connect_workers)
+        self._slow_pool = CTAPIWorkerPool("pyctapi-engine-slow", slow_workers)
+
+        self.connections = []
+        # Removed connections still waiting for their close step
+        self._removed = set()
+        # Connections currently running a step on a worker
+        self._executing = set()
+
+        # Connect attempts to hosts that already failed, capped so they
+        # cannot take every connect worker
+        self._failing_connects = 0
+        self._max_failing_connects = max(1, connect_workers - 1)
+        self._deferred_connects = deque()
+
+        self._thread = Thread(target=self._run, name="pyctapi-engine-scheduler", daemon=True)
+        self._thread.start()
+
+    def add_server(self, connection_params, dll_path=None, scan_rate=None, poll_group=None):
+        '''Add a server and schedule it to connect straight away'''
+        connection = CTAPIEngineConnection(
+            connection_params,
+            self._dll_path if dll_path is None else dll_path,
+            self._scan_rate if scan_rate is None else scan_rate,
+            poll_group,
+        )
+
+        with self._condition:
+            if not self._ok_to_run:
+                raise CTAPIEngineStopped("Cannot add %s, the engine has been stopped" % connection.host())
+
+            self.connections.append(connection)
+            self._schedule(connection, monotonic())
+
+        return connection
+
+    def add_cluster(self, cluster_params, dll_path=None, scan_rate=None):
+        '''Add redundant servers that share a poll group, only one of them delivers events'''
+        poll_group = CTAPIPollGroup()
+        return [self.add_server(server_params, dll_path, scan_rate, poll_group) for server_params in cluster_params]
+
+    def remove_server(self, connection):
+        with self._condition:
+            if not connection._ok_to_run:
+                return
+            connection._ok_to_run = False
+            self.connections.remove(connection)
+            self._removed.add(connection)
+
+            # Wake the connection now so it gets closed on a connect worker
+            if not connection._running:
+                self._schedule(connection, monotonic())
+
+    def add_list(self, list_name):
+        for con in list(self.connections):
+            con.add_list(list_name)
+
+    def add_tag(self, list_name, tag_name):
+        for con in list(self.connections):
+            con.add_tag(list_name, tag_name)
+
+    def subscribe(self, list_name, callback):
+        for con in list(self.connections):
+            con.subscribe(list_name, callback)
+
+    def thread_count(self):
+        return 1 + self._refresh_pool.thread_count() + self._connect_pool.thread_count() + self._slow_pool.thread_count()
+
+    def stats(self):
+        '''Per server scheduling statistics along with engine wide counters'''
+        with self._condition:
+            servers = []
+            for con in self.connections:
+                con.stats.holding_worker = con in self._executing
+                con.stats.stalled = con._stalled
+                con.stats.slow = con._slow
+                servers.append(con.stats.as_dict())
+
+            return {
+                "servers": servers,
+                "holding_worker": len(self._executing),
+                "stalled": sum(1 for con in self._executing if con._stalled),
+                "slow": sum(1 for con in self.connections if con._slow),
+                "threads": self.thread_count(),
+            }
+
+    def _schedule(self, connection, due):
+        # Must be called with the condition held, bumping the token
+        # invalidates any entry already queued for this connection
+        connection._token += 1
+        heappush(self._queue, (due, next(self._sequence), connection, connection._token))
+        self._condition.notify()
+
+    def _check_overruns(self, now):
+        '''Flag steps that overran their budget, returns when the next one would'''
+        next_deadline = None
+        for connection in self._executing:
+            if connection._stalled:
+                continue
+
+            deadline = connection._started + self._step_budget
+            if deadline <= now:
+                print(connection.host(), "Step overran its budget, moving to the slow pool")
+                connection._stalled = True
+                connection._slow = connection._slow or connection._pool is not self._connect_pool
+                connection.stats.overruns += 1
+                connection._pool.stall()
+            elif next_deadline == None or deadline < next_deadline:
+                next_deadline = deadline
+
+        return next_deadline
+
+    def _pool_for(self, connection):
+        # Must be called with the condition held, returns None if the
+        # connection has to wait for a connect worker
+        if connection._ctapi == None or connection._closing or not connection._ok_to_run:
+            failing = connection._ok_to_run and connection._ctapi == None and connection._backoff_time > MIN_BACKOFF_TIME
+            if failing:
+                if self._failing_connects >= self._max_failing_connects:
+                    return None
+                self._failing_connects += 1
+                connection._failing_connect = True
+            return self._connect_pool
+
+        if connection._slow:
+            return self._slow_pool
+        return self._refresh_pool
+
+    def _run(self):
+        print("Engine scheduler running")
+        with self._condition:
+            while self._ok_to_run:
+                now = monotonic()
+                timeout = None
+                next_deadline = self._check_overruns(now)
+                if next_deadline != None:
+                    timeout = next_deadline - now
+
+                if len(self._queue) == 0 or self._queue[0][0] > now:
+                    if len(self._queue) != 0:
+                        due_in = self._queue[0][0] - now
+                        timeout = due_in if timeout == None else min(timeout, due_in)
+                    self._condition.wait(timeout)
+                    continue
+
+                due, _, connection, token = heappop(self._queue)
+                if token != connection._token or connection._running:
+                    continue
+
+                pool = self._pool_for(connection)
+                if pool == None:
+                    self._deferred_connects.append(connection)
+                    continue
+
+                connection._running = True
+                connection._pool = pool
+                pool.submit(self._run_connection, connection, due)
+
+    def _run_connection(self, connection, due):
+        with self._condition:
+            start = monotonic()
+            connection._started = start
+            self._executing.add(connection)
+            self._condition.notify()
+
+        delay = connection._scan_rate
+        try:
+            if not connection._ok_to_run:
+                connection._disconnect()
+            elif connection._closing:
+                connection._disconnect()
+                delay = connection._backoff_time
+            elif connection._ctapi == None:
+                delay = connection._connect_step()
+            else:
+                delay = connection._step()
+
+        except Exception as e:
+            print(connection.host(), "Unexpected error", e)
+            connection.stats.errors += 1
+            connection.stats.last_error = repr(e)
+            connection._close_later()
+            connection._increase_backoff_time()
+            delay = connection._backoff_time
+
+        finished = monotonic()
+
+        with self._condition:
+            stats = connection.stats
+            stats.runs += 1
+            stats.last_lag = start - due
+            stats.max_lag = max(stats.max_lag, stats.last_lag)
+            stats.last_run_time = finished - start
+            stats.max_run_time = max(stats.max_run_time, stats.last_run_time)
+            stats.total_run_time += stats.last_run_time
+
+            self._executing.discard(connection)
+            connection._started = None
+            connection._running = False
+
+            if connection._stalled:
+                connection._stalled = False
+                connection._pool.unstall()
+            elif stats.last_run_time > self._step_budget:
+                stats.overruns += 1
+                connection._slow = connection._slow or connection._pool is not self._connect_pool
+            elif connection._pool is self._slow_pool:
+                # Back within budget, return to the refresh pool
+                connection._slow = False
+
+            if connection._failing_connect:
+                connection._failing_connect = False
+                self._failing_connects -= 1
+                if len(self._deferred_connects) != 0:
+                    self._schedule(self._deferred_connects.popleft(), finished)
+
+            if not self._ok_to_run:
+                return
+
+            if not connection._ok_to_run:
+                # Removed while this step was running, close it on the next pass
+                if connection._ctapi != None:
+                    self._schedule(connection, finished)
+                else:
+                    self._removed.discard(connection)
+                return
+
+            if connection._closing:
+                # Close straight away on a connect worker, reconnect after the backoff
+                self._schedule(connection, finished)
+                return
+
+            self._schedule(connection, finished + delay)
+
+    def die(self):
+        print("Stopping engine")
+        with self._condition:
+            self._ok_to_run = False
+            self._condition.notify()
+
+        self._thread.join()
+        self._refresh_pool.shutdown(self._step_budget)
+        self._connect_pool.shutdown(self._step_budget)
+        self._slow_pool.shutdown(self._step_budget)
+
+        with self._condition:
+            connections = self.connections + list(self._removed)
+            self._removed.clear()
+            executing = set(self._executing)
+
+        for con in connections:
+            # Closing a session under a call that is still hung would race it
+            if con in executing:
+                print(con.host(), "Still running a stalled step, not closed")
+                continue
+            con._disconnect()
@@ -23,9 +23,8 @@ import platform
 if platform.system() != "Windows":
     raise OSError
 
-from datetime import datetime
-from ctypes import CDLL, windll, create_string_buffer, byref, sizeof, GetLastError
-from ast import literal_eval
+from threading import Lock
+from ctypes import CDLL, WinDLL, create_string_buffer, byref, sizeof, GetLastError
 
 ERROR_USER_DEFINED_BASE = 0x10000000
 
@@ -88,52 +87,96 @@ CITECT_ERRORS = {
     "424" : "Tag not found"
 }
 
+DEFAULT_DLL_PATH = "C:/Program Files (x86)/Schneider Electric/CitectSCADA 7.50/Bin"
+
+# Process wide state, the DLLs are only ever loaded once per dll_path
+# and every wrapper for that path shares the same CtApi handle
+_library_lock = Lock()
+_libraries = {}
+_wrappers = {}
+
+def load_library(dll_path=DEFAULT_DLL_PATH):
+    '''Load the CtAPI DLLs found in dll_path and return the CtApi handle.
+
+    Safe to call from any thread, the DLLs are only loaded on the first call
+    for a given path. Call this during service startup to preload the library
+    so new connections and reconnects skip the library setup.'''
+    library = _libraries.get(dll_path)
+    if library != None:
+        return library
+
+    with _library_lock:
+        library = _libraries.get(dll_path)
+        if library == None:
+            CDLL(dll_path + '/CiDebugHelp')
+            CDLL(dll_path + '/CtUtil32')
+            CDLL(dll_path + '/Ct_ipc')
+            library = WinDLL(dll_path + '/CtApi')
+            _libraries[dll_path] = library
+
+    return library
+
+def get_wrapper(dll_path=DEFAULT_DLL_PATH):
+    '''Return the process wide CTAPIWrapper for dll_path'''
+    wrapper = _wrappers.get(dll_path)
+    if wrapper != None:
+        return wrapper
+
+    with _library_lock:
+        return _wrappers.setdefault(dll_path, CTAPIWrapper(dll_path))
+
 class CTAPIWrapper:
-    '''A plain ctypes wrapper around the CitectSCADA CtAPI DLLs'''
-    def __init__(self, dll_path):
-        CDLL(dll_path + '/CiDebugHelp')
-        CDLL(dll_path + '/CtUtil32')
-        CDLL(dll_path + '/Ct_ipc')
-        CDLL(dll_path + '/CtApi')
+    '''A plain ctypes wrapper around the CitectSCADA CtAPI DLLs
+
+    The DLLs are not loaded until the first CtAPI call is made'''
+    def __init__(self, dll_path=DEFAULT_DLL_PATH):
+        self._dll_path = dll_path
+        self._library = None
+
+    @property
+    def _ctapi(self):
+        if self._library == None:
+            self._library = load_library(self._dll_path)
+        return self._library
 
     def ctOpen(self, host_address, username, password, mode=0):
-        return windll.CtApi.ctOpen(host_address.encode("ascii"), username.encode("ascii"), password.encode("ascii"), mode)
+        return self._ctapi.ctOpen(host_address.encode("ascii"), username.encode("ascii"), password.encode("ascii"), mode)
 
     def ctClose(self, connection):
-        return windll.CtApi.ctClose(connection)
+        return self._ctapi.ctClose(connection)
 
     def ctCicode(self, connection, function, buff, hWin=0, overlapped=None):
-        return windll.CtApi.ctCicode(connection, function.encode("ascii"), hWin, 0, byref(buff), sizeof(buff), overlapped)
+        return self._ctapi.ctCicode(connection, function.encode("ascii"), hWin, 0, byref(buff), sizeof(buff), overlapped)
 
     def ctTagWrite(self, connection, tag_name, value):
-        return windll.CtApi.ctTagWrite(connection, tag_name.encode("ascii"), str(value).encode("ascii"))
+        return self._ctapi.ctTagWrite(connection, tag_name.encode("ascii"), str(value).encode("ascii"))
 
     def ctTagRead(self, connection, tag_name, buff):
-        return windll.CtApi.ctTagRead(connection, tag_name.encode("ascii"), byref(buff), sizeof(buff))
+        return self._ctapi.ctTagRead(connection, tag_name.encode("ascii"), byref(buff), sizeof(buff))
 
     def ctListNew(self, connection, mode):
-        return windll.CtApi.ctListNew(connection, mode)
+        return self._ctapi.ctListNew(connection, mode)
 
     def ctListFree(self, _list):
-        return windll.CtApi.ctListFree(_list)
+        return self._ctapi.ctListFree(_list)
 
     def ctListAdd(self, _list, tag_name):
-        return windll.CtApi.ctListAdd(_list, tag_name.encode("ascii"))
+        return self._ctapi.ctListAdd(_list, tag_name.encode("ascii"))
 
     def ctListDelete(self, tag_handle):
-        windll.CtApi.ctListDelete(tag_handle)
+        self._ctapi.ctListDelete(tag_handle)
 
     def ctListRead(self, _list, overlapped=None):
-        return windll.CtApi.ctListRead(_list, overlapped)
+        return self._ctapi.ctListRead(_list, overlapped)
 
     def ctListWrite(self, tag_handle, value, overlapped=None):
-        return windll.CtApi.ctListWrite(tag_handle, str(value).encode("ascii"), overlapped)
+        return self._ctapi.ctListWrite(tag_handle, str(value).encode("ascii"), overlapped)
 
     def ctListData(self, tag_handle, buff):
-        return windll.CtApi.ctListData(tag_handle, byref(buff), sizeof(buff), 0)
+        return self._ctapi.ctListData(tag_handle, byref(buff), sizeof(buff), 0)
 
     def ctListEvent(self, connection, mode):
-        return windll.CtApi.ctListEvent(connection, mode)
+        return self._ctapi.ctListEvent(connection, mode)
 
     def getErrorCode(self):
          return GetLastError()